@@ -19,9 +19,14 @@ def parse_args():
     )
     parser.add_argument(
         "--ignore_classes_for_layout",
-        type=list, default=["figure", "table", "chart"],
+        nargs="+", type=str, default=["figure", "table", "chart"],
         help="List of layout classes to ignore. This is used only for layout evaluation."
     )
+    parser.add_argument(
+        "--n_jobs",
+        type=int, default=1,
+        help="Number of processes to use. This is used only for table evaluation."
+    )
     parser.add_argument(
         "--mode",
         type=str, default="layout",
@@ -51,7 +56,10 @@ def main():
         )
         print(f"NID Score: {score:.4f}")
     elif args.mode == "table":
-        teds_score, teds_s_score = evaluate_table(label_data, pred_data)
+        teds_score, teds_s_score = evaluate_table(
+            label_data, pred_data,
+            n_jobs=args.n_jobs,
+        )
         print(f"TEDS Score: {teds_score:.4f}")
         print(f"TEDS-S Score: {teds_s_score:.4f}")
     else:
@@ -1,11 +1,19 @@
 import os
 import cv2
-import json
 import time
+import random
 import boto3
 import argparse
+import threading
 
-from utils import read_file_paths, validate_json_save_path, load_json_file
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from botocore.exceptions import ClientError
+
+from utils import (
+    read_file_paths, validate_json_save_path, load_json_file, save_json_file, save_result_file,
+    load_processed_keys, compute_file_hash,
+    append_jsonl_file, load_jsonl_file
+)
 
 CATEGORY_MAP = {
     "LAYOUT_TEXT": "paragraph",
@@ -17,20 +25,29 @@ CATEGORY_MAP = {
     "LAYOUT_TABLE": "table",
     "LAYOUT_TITLE": "heading1",
     "LAYOUT_SECTION_HEADER": "heading1",
+    "LAYOUT_KEY_VALUE": "paragraph",
     "TABLE": "table"
 }
 
+# layout blocks converted to text elements; tables are built from TABLE blocks instead
+TEXT_LAYOUT_TYPES = frozenset(
+    block_type for block_type in CATEGORY_MAP
+    if block_type.startswith("LAYOUT_") and block_type not in ("LAYOUT_LIST", "LAYOUT_TABLE")
+)
+
 
 class AWSInference:
     def __init__(
         self,
         save_path,
-        input_formats=[".pdf", ".jpg", ".jpeg", ".png", ".bmp", ".tiff", ".heic"]
+        input_formats=[".pdf", ".jpg", ".jpeg", ".png", ".bmp", ".tiff", ".heic"],
+        max_workers=8
     ):
         """Initialize the AWSInference class
         Args:
             save_path (str): the json path to save the results
             input_formats (list, optional): the supported file formats.
+            max_workers (int, optional): the number of documents processed concurrently.
         """
         AWS_ACCESS_KEY_ID = os.getenv("AWS_ACCESS_KEY_ID") or ""
         AWS_SECRET_ACCESS_KEY = os.getenv("AWS_SECRET_ACCESS_KEY") or ""
@@ -47,26 +64,56 @@ class AWSInference:
             aws_secret_access_key=AWS_SECRET_ACCESS_KEY
         )
 
-        self.s3 = boto3.resource("s3")
+        # boto3 clients are thread-safe, unlike resources
+        self.s3 = boto3.client("s3")
         self.s3_bucket_name = AWS_S3_BUCKET_NAME
 
         validate_json_save_path(save_path)
         self.save_path = save_path
-        self.processed_data = load_json_file(save_path)
+        # skipping documents only needs their names, the previous results
+        # themselves are loaded once the new ones are saved
+        self.processed_names = load_processed_keys(save_path)
+        self._processed_data = None
+        self.raw_save_path = os.path.splitext(save_path)[0] + "_raw.jsonl"
+
+        # Textract job ids keyed by document hash, so reruns reuse finished jobs
+        self.job_cache_path = os.path.splitext(save_path)[0] + "_textract_jobs.json"
+        self.job_cache = load_json_file(self.job_cache_path)
+        self.job_cache_lock = threading.Lock()
 
         self.formats = input_formats
+        self.max_workers = max_workers
+
+    @property
+    def processed_data(self):
+        # the previous results are only needed when saving, not to decide what to skip
+        if self._processed_data is None:
+            self._processed_data = load_json_file(self.save_path)
+        return self._processed_data
 
     def post_process(self, data):
         def get_text(result, blocks_map):
-            text = ""
-            if "Relationships" in result:
-                for relationship in result["Relationships"]:
-                    if relationship["Type"] == "CHILD":
-                        for child_id in relationship["Ids"]:
-                            word = blocks_map[child_id]
-                            if word["BlockType"] == "WORD":
-                                text += " " + word["Text"]
-            return text[1:]
+            words = []
+            for relationship in result.get("Relationships", []):
+                if relationship["Type"] == "CHILD":
+                    for child_id in relationship["Ids"]:
+                        word = blocks_map[child_id]
+                        if word["BlockType"] == "WORD":
+                            words.append(word["Text"])
+            return " ".join(words)
+
+        def bbox_to_xy(bbox):
+            x = bbox["Left"]
+            y = bbox["Top"]
+            x2 = x + bbox["Width"]
+            y2 = y + bbox["Height"]
+
+            return [
+                {"x": x, "y": y},
+                {"x": x2, "y": y},
+                {"x": x2, "y": y2},
+                {"x": x, "y": y2}
+            ]
 
         processed_dict = {}
         for input_key in data.keys():
@@ -76,44 +123,32 @@ class AWSInference:
                 "elements": []
             }
 
-            all_elems = {}
-            for page_data in output_data:
-                for elem in page_data["Blocks"]:
-                    _id = elem["Id"]
-                    all_elems[_id] = elem
+            all_elems = {
+                elem["Id"]: elem
+                for page_data in output_data
+                for elem in page_data["Blocks"]
+            }
 
             for page_data in output_data:
                 for idx, elem in enumerate(page_data["Blocks"]):
-                    if elem["BlockType"] == "LAYOUT_LIST":
-                        continue
-
-                    if "LAYOUT" in elem["BlockType"] and elem["BlockType"] != "LAYOUT_TABLE":
+                    block_type = elem["BlockType"]
 
-                        bbox = elem["Geometry"]["BoundingBox"]
+                    if block_type in TEXT_LAYOUT_TYPES:
 
-                        x = bbox["Left"]
-                        y = bbox["Top"]
-                        w = bbox["Width"]
-                        h = bbox["Height"]
+                        xy_coord = bbox_to_xy(elem["Geometry"]["BoundingBox"])
 
-                        coord = [
-                            [x, y],
-                            [x + w, y],
-                            [x + w, y + h],
-                            [x, y + h]
-                        ]
-                        xy_coord = [{"x": x, "y": y} for x, y in coord]
+                        category = CATEGORY_MAP.get(block_type, "paragraph")
 
-                        category = CATEGORY_MAP.get(elem["BlockType"], "paragraph")
+                        lines = []
 
-                        transcription = ""
-
-                        if elem["BlockType"] != "LAYOUT_FIGURE":
+                        if block_type != "LAYOUT_FIGURE":
                             for item in all_elems[elem["Id"]]["Relationships"]:
                                 for id_ in item["Ids"]:
                                     if all_elems[id_]["BlockType"] == "LINE":
                                         word = all_elems[id_]["Text"]
-                                        transcription += word + "\n"
+                                        lines.append(word + "\n")
+
+                        transcription = "".join(lines)
 
                         data_dict = {
                             "coordinates": xy_coord,
@@ -127,67 +162,55 @@ class AWSInference:
                         }
                         processed_dict[input_key]["elements"].append(data_dict)
 
-                    elif elem["BlockType"] == "TABLE":
-
-                        bbox = elem["Geometry"]["BoundingBox"]
+                    elif block_type == "TABLE":
 
-                        x = bbox["Left"]
-                        y = bbox["Top"]
-                        w = bbox["Width"]
-                        h = bbox["Height"]
+                        xy_coord = bbox_to_xy(elem["Geometry"]["BoundingBox"])
 
-                        coord = [
-                            [x, y],
-                            [x + w, y],
-                            [x + w, y + h],
-                            [x, y + h]
-                        ]
-                        xy_coord = [{"x": x, "y": y} for x, y in coord]
+                        category = CATEGORY_MAP.get(block_type, "paragraph")
 
-                        category = CATEGORY_MAP.get(elem["BlockType"], "paragraph")
+                        # group the related block ids by relationship type in a single pass
+                        relationship_ids = {}
+                        for relationship in elem["Relationships"]:
+                            relationship_ids.setdefault(relationship["Type"], []).extend(relationship["Ids"])
 
                         table_cells = {}
-                        for relationship in elem["Relationships"]:
-                            if relationship["Type"] == "CHILD":
-                                for cell_id in relationship["Ids"]:
-                                    cell_block = next((block for block in page_data["Blocks"] if block["Id"] == cell_id), None)
-                                    if cell_block is not None and cell_block["BlockType"] == "CELL":
-                                        row_index = cell_block["RowIndex"] - 1
-                                        column_index = cell_block["ColumnIndex"] - 1
-                                        row_span = cell_block["RowSpan"]
-                                        column_span = cell_block["ColumnSpan"]
-                                        table_cells[(row_index, column_index)] = {
-                                            "block": cell_block,
-                                            "span": (row_span, column_span),
-                                            "text": get_text(cell_block, all_elems),
-                                        }
+                        for cell_id in relationship_ids.get("CHILD", []):
+                            cell_block = all_elems.get(cell_id)
+                            if cell_block is not None and cell_block["BlockType"] == "CELL":
+                                row_index = cell_block["RowIndex"] - 1
+                                column_index = cell_block["ColumnIndex"] - 1
+                                row_span = cell_block["RowSpan"]
+                                column_span = cell_block["ColumnSpan"]
+                                table_cells[(row_index, column_index)] = {
+                                    "block": cell_block,
+                                    "span": (row_span, column_span),
+                                    "text": get_text(cell_block, all_elems),
+                                }
                         max_row_index = max(cell[0] for cell in table_cells.keys())
                         max_column_index = max(cell[1] for cell in table_cells.keys())
-                        for relationship in elem["Relationships"]:
-                            if relationship["Type"] == "MERGED_CELL":
-                                for cell_id in relationship["Ids"]:
-                                    cell_block = next((block for block in page_data["Blocks"] if block["Id"] == cell_id), None)
-                                    if cell_block is not None and cell_block["BlockType"] == "MERGED_CELL":
-                                        row_index = cell_block["RowIndex"] - 1
-                                        column_index = cell_block["ColumnIndex"] - 1
-                                        row_span = cell_block["RowSpan"]
-                                        column_span = cell_block["ColumnSpan"]
-                                        for i in range(row_span):
-                                            for j in range(column_span):
-                                                del table_cells[(row_index + i, column_index + j)]
-                                        text = ""
-                                        for child_ids in cell_block["Relationships"][0]["Ids"]:
-                                            child_cell_block = next((block for block in page_data["Blocks"] if block["Id"] == child_ids), None)
-                                            text += " " + get_text(child_cell_block, all_elems)
-                                        table_cells[(row_index, column_index)] = {
-                                            "block": cell_block,
-                                            "span": (row_span, column_span),
-                                            "text": text[1:],
-                                        }
-                        html_table = "<table>"
+                        for cell_id in relationship_ids.get("MERGED_CELL", []):
+                            cell_block = all_elems.get(cell_id)
+                            if cell_block is not None and cell_block["BlockType"] == "MERGED_CELL":
+                                row_index = cell_block["RowIndex"] - 1
+                                column_index = cell_block["ColumnIndex"] - 1
+                                row_span = cell_block["RowSpan"]
+                                column_span = cell_block["ColumnSpan"]
+                                for i in range(row_span):
+                                    for j in range(column_span):
+                                        del table_cells[(row_index + i, column_index + j)]
+                                texts = []
+                                for child_ids in cell_block["Relationships"][0]["Ids"]:
+                                    child_cell_block = all_elems.get(child_ids)
+                                    texts.append(get_text(child_cell_block, all_elems))
+                                table_cells[(row_index, column_index)] = {
+                                    "block": cell_block,
+                                    "span": (row_span, column_span),
+                                    "text": " ".join(texts),
+                                }
+                        html_parts = ["<table>"]
 
                         for row_index in range(max_row_index + 1):
-                            html_table += "<tr>"
+                            html_parts.append("<tr>")
                             for column_index in range(max_column_index + 1):
                                 cell_data = table_cells.get((row_index, column_index))
                                 if cell_data:
@@ -195,9 +218,11 @@ class AWSInference:
                                     row_span, column_span = cell_data["span"]
 
                                     cell_text = cell_data["text"]
-                                    html_table += f"<td rowspan='{row_span}' colspan='{column_span}''>{cell_text}</td>"
-                            html_table += "</tr>"
-                        html_table += "</table>"
+                                    html_parts.append(f"<td rowspan='{row_span}' colspan='{column_span}'>{cell_text}</td>")
+                            html_parts.append("</tr>")
+                        html_parts.append("</table>")
+
+                        html_table = "".join(html_parts)
 
                         data_dict = {
                             "coordinates": xy_coord,
@@ -211,112 +236,206 @@ class AWSInference:
                         }
                         processed_dict[input_key]["elements"].append(data_dict)
 
-        for key in self.processed_data:
-            processed_dict[key] = self.processed_data[key]
+        processed_dict.update(self.processed_data)
 
         return processed_dict
 
 
-    def start_job(self, object_name):
-        filename_with_ext = os.path.basename(object_name)
+    def is_uploaded(self, key):
+        try:
+            self.s3.head_object(Bucket=self.s3_bucket_name, Key=key)
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+                return False
+            raise
+
+        return True
+
+    def get_cached_job(self, file_hash):
+        job_id = self.job_cache.get(file_hash)
+        if job_id is None:
+            return None
+
+        # Textract only keeps job results for a limited time
+        try:
+            response = self.client.get_document_analysis(JobId=job_id, MaxResults=1)
+        except ClientError as e:
+            if e.response["Error"]["Code"] == "InvalidJobIdException":
+                return None
+            raise
+
+        if response["JobStatus"] == "FAILED":
+            return None
 
-        print(f"uploading {filename_with_ext} to s3")
-        self.s3.Bucket(self.s3_bucket_name).upload_file(object_name, filename_with_ext)
+        return job_id
+
+    def start_job(self, object_name, file_hash=None):
+        filename_with_ext = os.path.basename(object_name)
+        if file_hash is None:
+            file_hash = compute_file_hash(object_name)
+
+        job_id = self.get_cached_job(file_hash)
+        if job_id is not None:
+            print(f"reusing job {job_id} for {filename_with_ext}")
+            return job_id
+
+        # the content hash prefix lets identical documents share a single upload
+        key = f"{file_hash}/{filename_with_ext}"
+        if self.is_uploaded(key):
+            print(f"{filename_with_ext} is already uploaded to s3")
+        else:
+            print(f"uploading {filename_with_ext} to s3")
+            self.s3.upload_file(str(object_name), self.s3_bucket_name, key)
 
         response = None
         response = self.client.start_document_analysis(
             DocumentLocation={
                 "S3Object": {
                     "Bucket": self.s3_bucket_name,
-                    "Name": filename_with_ext
+                    "Name": key
                 }
             },
             FeatureTypes = ["LAYOUT", "TABLES"]
         )
+        job_id = response["JobId"]
 
-        return response["JobId"]
+        with self.job_cache_lock:
+            self.job_cache[file_hash] = job_id
+            save_json_file(self.job_cache_path, self.job_cache)
 
-    def is_job_complete(self, job_id):
-        time.sleep(1)
-        response = self.client.get_document_analysis(JobId=job_id)
-        status = response["JobStatus"]
-        print("Job status: {}".format(status))
+        return job_id
 
-        while(status == "IN_PROGRESS"):
-            time.sleep(1)
+    def get_job_results(self, job_id, max_delay=8.0):
+        # poll with jittered exponential backoff until the job has finished
+        delay = 0.5
+        while True:
+            time.sleep(delay + random.uniform(0, delay * 0.1))
             response = self.client.get_document_analysis(JobId=job_id)
             status = response["JobStatus"]
             print("Job status: {}".format(status))
 
-        return status
+            if status != "IN_PROGRESS":
+                break
+            delay = min(delay * 1.5, max_delay)
+
+        if status == "FAILED":
+            raise RuntimeError(f"Textract job {job_id} failed: {response.get('StatusMessage')}")
 
-    def get_job_results(self, job_id):
-        pages = []
-        time.sleep(1)
-        response = self.client.get_document_analysis(JobId=job_id)
-        pages.append(response)
+        # the final status response already holds the first page of results
+        pages = [response]
         print("Resultset page received: {}".format(len(pages)))
-        next_token = None
-        if "NextToken" in response:
-            next_token = response["NextToken"]
+        next_token = response.get("NextToken")
 
         while next_token:
-            time.sleep(1)
             response = self.client.\
                 get_document_analysis(JobId=job_id, NextToken=next_token)
             pages.append(response)
             print("Resultset page received: {}".format(len(pages)))
-            next_token = None
-            if "NextToken" in response:
-                next_token = response["NextToken"]
+            next_token = response.get("NextToken")
 
         return pages
 
-    def infer(self, file_path):
-        """Infer the layout of the documents in the given file path
+    def process_document(self, filepath, file_hash=None):
+        if os.path.splitext(filepath)[-1] == ".pdf":
+            job_id = self.start_job(filepath, file_hash=file_hash)
+            print("Started job with id: {}".format(job_id))
+            result = self.get_job_results(job_id)
+        else:
+            with open(filepath, "rb") as file:
+                image_bytes = file.read()
+
+            result = self.client.analyze_document(
+                Document={"Bytes": image_bytes},
+                FeatureTypes = ["LAYOUT", "TABLES"]
+            )
+
+        return result
+
+    def run_inference(self, file_path):
+        """Run the API on the documents in the given file path
         Args:
             file_path (str): the path to the file or directory containing the documents to process
+        Returns:
+            tuple(dict, list): the raw API responses keyed by file name and the files that failed
         """
         paths = read_file_paths(file_path, supported_formats=self.formats)
 
         error_files = []
 
-        result_dict = {}
-        for idx, filepath in enumerate(paths):
-            print("({}/{}) {}".format(idx+1, len(paths), filepath))
-
+        needed_paths = []
+        for filepath in paths:
             filename = filepath.name
-            if filename in self.processed_data.keys():
+            if filename in self.processed_names:
                 print(f"'{filename}' is already in the loaded dictionary. Skipping this sample")
                 continue
 
-            try:
-                if os.path.splitext(filepath)[-1] == ".pdf":
-                    job_id = self.start_job(filepath)
-                    print("Started job with id: {}".format(job_id))
-                    if self.is_job_complete(job_id):
-                        result = self.get_job_results(job_id)
-                else:
-                    with open(filepath, "rb") as file:
-                        img_test = file.read()
-                        bytes_test = bytearray(img_test)
-
-                    result = self.client.analyze_document(
-                        Document={"Bytes": bytes_test},
-                        FeatureTypes = ["LAYOUT", "TABLES"]
-                    )
-            except Exception as e:
-                print(e)
-                print("Error processing document..")
-                error_files.append(filepath)
+            needed_paths.append(filepath)
+
+        # raw responses of the needed documents saved by an earlier, possibly interrupted, run
+        raw_results = load_jsonl_file(
+            self.raw_save_path, names={filepath.name for filepath in needed_paths}
+        )
+
+        result_dict = {}
+        remaining_paths = []
+        for filepath in needed_paths:
+            filename = filepath.name
+            if filename in raw_results:
+                print(f"'{filename}' already has a saved API response. Reusing it")
+                result_dict[filename] = raw_results[filename]
                 continue
 
-            result_dict[filename] = result
+            remaining_paths.append(filepath)
+
+        # byte-identical documents are sent to the API only once
+        paths_by_hash = {}
+        for filepath in remaining_paths:
+            paths_by_hash.setdefault(compute_file_hash(filepath), []).append(filepath)
+
+        # documents are processed concurrently since each one mostly waits on the API
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {
+                executor.submit(self.process_document, filepaths[0], file_hash): filepaths
+                for file_hash, filepaths in paths_by_hash.items()
+            }
+            for idx, future in enumerate(as_completed(futures)):
+                filepaths = futures[future]
+                print("({}/{}) {}".format(idx+1, len(futures), filepaths[0]))
+
+                try:
+                    result = future.result()
+                except Exception as e:
+                    print(e)
+                    print("Error processing document..")
+                    error_files.extend(filepaths)
+                    continue
+
+                for filepath in filepaths:
+                    result_dict[filepath.name] = result
+                    append_jsonl_file(self.raw_save_path, {filepath.name: result})
+
+        return result_dict, error_files
+
+    def infer(self, file_path, reprocess=False):
+        """Infer the layout of the documents in the given file path
+        Args:
+            file_path (str): the path to the file or directory containing the documents to process
+            reprocess (bool, optional): post-process the saved raw responses instead of calling the API.
+        """
+        if reprocess:
+            print("Reprocessing raw results from: {}".format(self.raw_save_path))
+            result_dict = load_jsonl_file(self.raw_save_path)
+            error_files = []
+
+            # reprocessed documents replace their previously saved results
+            for filename in result_dict:
+                self.processed_data.pop(filename, None)
+        else:
+            result_dict, error_files = self.run_inference(file_path)
 
         result_dict = self.post_process(result_dict)
 
-        with open(self.save_path, "w", encoding="utf-8") as f:
-            json.dump(result_dict, f, ensure_ascii=False, indent=4)
+        save_result_file(self.save_path, result_dict, indent=True)
 
         for error_file in error_files:
             print(f"Error processing file: {error_file}")
@@ -340,15 +459,26 @@ if __name__ == "__main__":
     )
     args.add_argument(
         "--input_formats",
-        type=list, default=[
+        nargs="+", type=str, default=[
             ".pdf", ".jpg", ".jpeg", ".png", ".bmp", ".tiff", ".heic"
         ],
         help="Supported input file formats"
     )
+    args.add_argument(
+        "--max_workers",
+        type=int, default=8,
+        help="Number of documents to process concurrently"
+    )
+    args.add_argument(
+        "--reprocess",
+        action="store_true",
+        help="Post-process the saved raw API responses instead of running inference"
+    )
     args = args.parse_args()
 
     aws_inference = AWSInference(
         args.save_path,
-        input_formats=args.input_formats
+        input_formats=args.input_formats,
+        max_workers=args.max_workers
     )
-    aws_inference.infer(args.data_path)
+    aws_inference.infer(args.data_path, reprocess=args.reprocess)
@@ -1,15 +1,18 @@
 import os
-import json
-import google
 import argparse
 
 from glob import glob
 from typing import Optional, Sequence
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from google.api_core.client_options import ClientOptions
 from google.cloud import documentai
 
-from utils import read_file_paths, validate_json_save_path, load_json_file
+from utils import (
+    read_file_paths, validate_json_save_path, load_json_file, save_result_file,
+    load_processed_keys, compute_file_hash,
+    append_jsonl_file, load_jsonl_file
+)
 
 CATEGORY_MAP = {
     "paragraph": "paragraph",
@@ -22,17 +25,29 @@ CATEGORY_MAP = {
     "title": "heading1"
 }
 
+SUFFIX_TO_MIME = {
+    ".pdf": "application/pdf",
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+    ".png": "image/png",
+    ".bmp": "image/bmp",
+    ".tiff": "image/tiff",
+    ".heic": "image/heic"
+}
+
 
 class GoogleInference:
     def __init__(
         self,
         save_path,
-        input_formats=[".pdf", ".jpg", ".jpeg", ".png", ".bmp", ".tiff", ".heic"]
+        input_formats=[".pdf", ".jpg", ".jpeg", ".png", ".bmp", ".tiff", ".heic"],
+        max_workers=8
     ):
         """Initialize the GoogleInference class
         Args:
             save_path (str): the json path to save the results
             input_formats (list, optional): the supported file formats.
+            max_workers (int, optional): the number of documents processed concurrently.
         """
         self.project_id = os.getenv("GOOGLE_PROJECT_ID") or ""
         self.processor_id = os.getenv("GOOGLE_PROCESSOR_ID") or ""
@@ -44,11 +59,36 @@ class GoogleInference:
 
         self.processor_version = "rc"
 
+        # a single client keeps one gRPC channel, shared by all worker threads
+        self.client = documentai.DocumentProcessorServiceClient(
+            client_options=ClientOptions(
+                api_endpoint=f"{self.endpoint}"
+            )
+        )
+        self.processor_name = self.client.processor_version_path(
+            self.project_id,
+            self.location,
+            self.processor_id,
+            self.processor_version
+        )
+
         validate_json_save_path(save_path)
         self.save_path = save_path
-        self.processed_data = load_json_file(save_path)
+        # skipping documents only needs their names, the previous results
+        # themselves are loaded once the new ones are saved
+        self.processed_names = load_processed_keys(save_path)
+        self._processed_data = None
+        self.raw_save_path = os.path.splitext(save_path)[0] + "_raw.jsonl"
 
         self.formats = input_formats
+        self.max_workers = max_workers
+
+    @property
+    def processed_data(self):
+        # the previous results are only needed when saving, not to decide what to skip
+        if self._processed_data is None:
+            self._processed_data = load_json_file(self.save_path)
+        return self._processed_data
 
     @staticmethod
     def generate_html_table(table_data):
@@ -71,29 +111,27 @@ class GoogleInference:
     def iterate_blocks(data):
         block_sequence = []
 
-        def recurse_blocks(blocks):
-            for block in blocks:
-                block_id = block.get("blockId", "")
-                block_type = block.get("textBlock", {}).get("type", "")
-                block_text = block.get("textBlock", {}).get("text", "")
+        # depth-first traversal with an explicit stack, children in document order
+        stack = list(reversed(data.get("documentLayout", {}).get("blocks", [])))
+        while stack:
+            block = stack.pop()
+            block_id = block.get("blockId", "")
+            text_block = block.get("textBlock", {})
+            block_type = text_block.get("type", "")
 
-                if block_type:
-                    # Append block information as a tuple to the sequence list
-                    block_sequence.append((block_id, block_type, block_text))
+            if block_type:
+                # Append block information as a tuple to the sequence list
+                block_sequence.append((block_id, block_type, text_block.get("text", "")))
 
-                block_id = block.get("blockId", "")
-                block_table = block.get("tableBlock", {})
+            block_table = block.get("tableBlock", {})
 
-                if block_table:
-                    block_table_html = GoogleInference.generate_html_table(block_table)
-                    block_sequence.append((block_id, "table", block_table_html))
+            if block_table:
+                block_table_html = GoogleInference.generate_html_table(block_table)
+                block_sequence.append((block_id, "table", block_table_html))
 
-                # If the block contains sub-blocks, recurse through them
-                if block.get("textBlock", {}).get("blocks", []):
-                    recurse_blocks(block["textBlock"]["blocks"])
-
-        if "documentLayout" in data:
-            recurse_blocks(data["documentLayout"].get("blocks", []))
+            # If the block contains sub-blocks, visit them next
+            if text_block.get("blocks", []):
+                stack.extend(reversed(text_block["blocks"]))
 
         return block_sequence
 
@@ -127,8 +165,7 @@ class GoogleInference:
 
                 id_counter += 1
 
-        for key in self.processed_data:
-            processed_dict[key] = self.processed_data[key]
+        processed_dict.update(self.processed_data)
 
         return processed_dict
 
@@ -147,7 +184,10 @@ class GoogleInference:
             process_options=process_options,
         )
 
-        document_dict = json.loads(google.cloud.documentai_v1.Document.to_json(document))
+        # convert the message directly, keeping the camelCase keys of Document.to_json
+        document_dict = documentai.Document.to_dict(
+            document, preserving_proto_field_name=False
+        )
 
         return document_dict
 
@@ -156,75 +196,113 @@ class GoogleInference:
         mime_type: str,
         process_options: Optional[documentai.ProcessOptions] = None,
     ) -> documentai.Document:
-        client = documentai.DocumentProcessorServiceClient(
-            client_options=ClientOptions(
-                api_endpoint=f"{self.endpoint}"
-            )
-        )
-
         with open(file_path, "rb") as image:
             image_content = image.read()
 
-        name = client.processor_version_path(
-            self.project_id,
-            self.location,
-            self.processor_id,
-            self.processor_version
-        )
         request = documentai.ProcessRequest(
-            name=name,
+            name=self.processor_name,
             raw_document=documentai.RawDocument(
                 content=image_content, mime_type=mime_type
             ),
             process_options=process_options,
         )
 
-        result = client.process_document(request=request)
+        result = self.client.process_document(request=request)
 
         return result.document
 
-    def infer(self, file_path):
-        """Infer the layout of the documents in the given file path
+    def run_inference(self, file_path):
+        """Run the API on the documents in the given file path
         Args:
             file_path (str): the path to the file or directory containing the documents to process
+        Returns:
+            tuple(dict, list): the raw API responses keyed by file name and the files that failed
         """
         paths = read_file_paths(file_path, supported_formats=self.formats)
 
         error_files = []
 
-        result_dict = {}
-        for idx, filepath in enumerate(paths):
-            print("({}/{}) {}".format(idx+1, len(paths), filepath))
-
-            if filepath.suffix == ".pdf":
-                mime_type = "application/pdf"
-            elif filepath.suffix == ".jpg" or filepath.suffix == ".jpeg":
-                mime_type = "image/jpeg"
-            elif filepath.suffix == ".png":
-                mime_type = "image/png"
-            else:
-                raise NotImplementedError
+        needed_paths = []
+        for filepath in paths:
+            mime_type = SUFFIX_TO_MIME.get(filepath.suffix.lower())
+            if mime_type is None:
+                print(f"Unsupported file format '{filepath.suffix}'")
+                error_files.append(filepath)
+                continue
 
             filename = filepath.name
 
-            if filename in self.processed_data.keys():
+            if filename in self.processed_names:
                 print(f"'{filename}' is already in the loaded dictionary. Skipping this sample")
                 continue
 
-            try:
-                document_dict = self.process_document_layout_sample(filepath, mime_type)
-            except Exception as e:
-                print(e)
-                print("Error processing document..")
-                error_files.append(filepath)
+            needed_paths.append((filepath, mime_type))
+
+        # raw responses of the needed documents saved by an earlier, possibly interrupted, run
+        raw_results = load_jsonl_file(
+            self.raw_save_path, names={filepath.name for filepath, _ in needed_paths}
+        )
+
+        result_dict = {}
+        remaining_paths = []
+        for filepath, mime_type in needed_paths:
+            filename = filepath.name
+            if filename in raw_results:
+                print(f"'{filename}' already has a saved API response. Reusing it")
+                result_dict[filename] = raw_results[filename]
                 continue
 
-            result_dict[filename] = document_dict
+            remaining_paths.append((filepath, mime_type))
+
+        # byte-identical documents are sent to the API only once
+        paths_by_hash = {}
+        for filepath, mime_type in remaining_paths:
+            paths_by_hash.setdefault(compute_file_hash(filepath), []).append((filepath, mime_type))
+
+        # documents are processed concurrently since each one mostly waits on the API
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {
+                executor.submit(self.process_document_layout_sample, *file_entries[0]): file_entries
+                for file_entries in paths_by_hash.values()
+            }
+            for idx, future in enumerate(as_completed(futures)):
+                filepaths = [filepath for filepath, _ in futures[future]]
+                print("({}/{}) {}".format(idx+1, len(futures), filepaths[0]))
+
+                try:
+                    document_dict = future.result()
+                except Exception as e:
+                    print(e)
+                    print("Error processing document..")
+                    error_files.extend(filepaths)
+                    continue
+
+                for filepath in filepaths:
+                    result_dict[filepath.name] = document_dict
+                    append_jsonl_file(self.raw_save_path, {filepath.name: document_dict})
+
+        return result_dict, error_files
+
+    def infer(self, file_path, reprocess=False):
+        """Infer the layout of the documents in the given file path
+        Args:
+            file_path (str): the path to the file or directory containing the documents to process
+            reprocess (bool, optional): post-process the saved raw responses instead of calling the API.
+        """
+        if reprocess:
+            print("Reprocessing raw results from: {}".format(self.raw_save_path))
+            result_dict = load_jsonl_file(self.raw_save_path)
+            error_files = []
+
+            # reprocessed documents replace their previously saved results
+            for filename in result_dict:
+                self.processed_data.pop(filename, None)
+        else:
+            result_dict, error_files = self.run_inference(file_path)
 
         result_dict = self.post_process(result_dict)
 
-        with open(self.save_path, "w") as f:
-            json.dump(result_dict, f)
+        save_result_file(self.save_path, result_dict)
 
         for error_file in error_files:
             print(f"Error processing file: {error_file}")
@@ -248,15 +326,26 @@ if __name__ == "__main__":
     )
     args.add_argument(
         "--input_formats",
-        type=list, default=[
+        nargs="+", type=str, default=[
             ".pdf", ".jpg", ".jpeg", ".png", ".bmp", ".tiff", ".heic"
         ],
         help="Supported input file formats"
     )
+    args.add_argument(
+        "--max_workers",
+        type=int, default=8,
+        help="Number of documents to process concurrently"
+    )
+    args.add_argument(
+        "--reprocess",
+        action="store_true",
+        help="Post-process the saved raw API responses instead of running inference"
+    )
     args = args.parse_args()
 
     google_inference = GoogleInference(
         args.save_path,
-        input_formats=args.input_formats
+        input_formats=args.input_formats,
+        max_workers=args.max_workers
     )
-    google_inference.infer(args.data_path)
+    google_inference.infer(args.data_path, reprocess=args.reprocess)
@@ -1,13 +1,16 @@
 import os
 import time
-import json
 import markdown
 import requests
+from requests.adapters import HTTPAdapter
 import argparse
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-from bs4 import BeautifulSoup
-from utils import read_file_paths, validate_json_save_path, load_json_file
+from utils import (
+    read_file_paths, validate_json_save_path, load_json_file, save_result_file,
+    load_processed_keys, append_jsonl_file, load_jsonl_file
+)
 
 
 CATEGORY_MAP = {
@@ -16,19 +19,25 @@ CATEGORY_MAP = {
     "table": "table"
 }
 
+# status codes of a poll that is retried in the next round, e.g. when throttled
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
 
 class LlamaParseInference:
     def __init__(
         self,
         save_path,
-        input_formats=[".pdf", ".jpg", ".jpeg", ".png", ".bmp", ".tiff", ".heic"]
+        input_formats=[".pdf", ".jpg", ".jpeg", ".png", ".bmp", ".tiff", ".heic"],
+        max_workers=8
     ):
         """Initialize the LlamaParseInference class
         Args:
             save_path (str): the json path to save the results
             input_formats (list, optional): the supported file formats.
+            max_workers (int, optional): the number of documents processed concurrently.
         """
         self.formats = input_formats
+        self.max_workers = max_workers
 
         self.api_key = os.getenv("LLAMAPARSE_API_KEY") or ""
         self.post_url = os.getenv("LLAMAPARSE_POST_URL") or ""
@@ -42,9 +51,30 @@ class LlamaParseInference:
               "Authorization": f"Bearer {self.api_key}",
         }
 
+        # the session shares pooled keep-alive connections between requests,
+        # sized so that every worker can keep its own connection open
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        # one reusable markdown converter instead of building the extension chain per table
+        self.md = markdown.Markdown(extensions=["markdown.extensions.tables"])
+
         validate_json_save_path(save_path)
         self.save_path = save_path
-        self.processed_data = load_json_file(save_path)
+        # skipping documents only needs their names, the previous results
+        # themselves are loaded once the new ones are saved
+        self.processed_names = load_processed_keys(save_path)
+        self._processed_data = None
+        self.raw_save_path = os.path.splitext(save_path)[0] + "_raw.jsonl"
+
+    @property
+    def processed_data(self):
+        # the previous results are only needed when saving, not to decide what to skip
+        if self._processed_data is None:
+            self._processed_data = load_json_file(self.save_path)
+        return self._processed_data
 
     def post_process(self, data):
         processed_dict = {}
@@ -59,28 +89,27 @@ class LlamaParseInference:
             for elem in output_data["pages"]:
                 for item in elem["items"]:
 
-                    coord = [[0, 0], [0, 0], [0, 0], [0, 0]]
+                    xy_coord = [{"x": 0, "y": 0} for _ in range(4)]
                     category = item["type"]
                     if category == "table":
-                        transcription = markdown.markdown(
-                            item["md"],
-                            extensions=["markdown.extensions.tables"]
-                        )
+                        transcription = self.md.reset().convert(item["md"])
                         transcription = transcription.replace("\n", "")
                     else:
                         transcription = item["value"]
                         pts = item["bBox"]
                         if "x" in pts and "y" in pts and \
                                 "w" in pts and "h" in pts:
-                            coord = [
-                                [pts["x"], pts["y"]],
-                                [pts["x"] + pts["w"], pts["y"]],
-                                [pts["x"] + pts["w"], pts["y"] + pts["h"]],
-                                [pts["x"], pts["y"] + pts["h"]],
+                            x = pts["x"]
+                            y = pts["y"]
+                            x2 = x + pts["w"]
+                            y2 = y + pts["h"]
+                            xy_coord = [
+                                {"x": x, "y": y},
+                                {"x": x2, "y": y},
+                                {"x": x2, "y": y2},
+                                {"x": x, "y": y2},
                             ]
 
-                    xy_coord = [{"x": x, "y": y} for x, y in coord]
-
                     category = CATEGORY_MAP.get(category, "paragraph")
                     data_dict = {
                         "coordinates": xy_coord,
@@ -96,11 +125,57 @@ class LlamaParseInference:
 
                     id_counter += 1
 
-        for key in self.processed_data:
-            processed_dict[key] = self.processed_data[key]
+        processed_dict.update(self.processed_data)
 
         return processed_dict
 
+    def submit_document(self, filepath):
+        with open(filepath, "rb") as file_data:
+            file_data = {
+                "file": ("dummy.pdf", file_data, "")
+            }
+            data = {
+                "invalidate_cache": True,
+                "premium_mode": True,
+                "disable_ocr": False
+            }
+            response = self.session.post(
+                self.post_url, headers=self.headers, files=file_data, data=data
+            )
+        response.raise_for_status()
+
+        return response.json()["id"]
+
+    def get_job_result(self, id_):
+        """Get the result of a parsing job
+        Args:
+            id_ (str): the id of the parsing job
+        Returns:
+            dict: the parsed document, or None if the job is still pending
+                or could not be polled in this round
+        """
+        get_url = f"{self.get_url}/{id_}"
+        response = self.session.get(get_url, headers=self.headers)
+        # a throttled or failed poll says nothing about the job itself,
+        # so it is polled again in the next round instead of being dropped
+        if response.status_code in RETRY_STATUS_CODES:
+            return None
+        response.raise_for_status()
+
+        status = response.json()["status"]
+        if status == "PENDING":
+            return None
+        if status != "SUCCESS":
+            raise RuntimeError(f"Parsing job {id_} finished with status {status}")
+
+        get_url = f"{self.get_url}/{id_}/result/json"
+        response = self.session.get(get_url, headers=self.headers)
+        if response.status_code in RETRY_STATUS_CODES:
+            return None
+        response.raise_for_status()
+
+        return response.json()
+
     def infer(self, file_path):
         """Infer the layout of the documents in the given file path
         Args:
@@ -110,57 +185,80 @@ class LlamaParseInference:
 
         error_files = []
 
-        result_dict = {}
+        needed_paths = []
         for filepath in paths:
-            print("({}/{}) Processing {}".format(paths.index(filepath) + 1, len(paths), filepath))
-
             filename = filepath.name
-            if filename in self.processed_data.keys():
+            if filename in self.processed_names:
                 print(f"'{filename}' is already in the loaded dictionary. Skipping this sample")
                 continue
 
-            try:
-                with open(filepath, "rb") as file_data:
-                    file_data = {
-                        "file": ("dummy.pdf", file_data, "")
-                    }
-                    data = {
-                        "invalidate_cache": True,
-                        "premium_mode": True,
-                        "disable_ocr": False
-                    }
-                    response = requests.post(
-                        self.post_url, headers=self.headers, files=file_data, data=data
-                    )
+            needed_paths.append(filepath)
 
-                result_data = response.json()
-                status = result_data["status"]
-                id_ = result_data["id"]
+        # raw responses of the needed documents saved by an earlier, possibly interrupted, run
+        raw_results = load_jsonl_file(
+            self.raw_save_path, names={filepath.name for filepath in needed_paths}
+        )
 
-                while status == "PENDING":
-                    get_url = f"{self.get_url}/{id_}"
-                    response = requests.get(get_url, headers=self.headers)
+        result_dict = {}
+        remaining_paths = []
+        for filepath in needed_paths:
+            filename = filepath.name
+            if filename in raw_results:
+                print(f"'{filename}' already has a saved API response. Reusing it")
+                result_dict[filename] = raw_results[filename]
+                continue
 
-                    response_json = response.json()
-                    status = response_json["status"]
-                    if status == "SUCCESS":
-                        get_url = f"{self.get_url}/{id_}/result/json"
-                        response = requests.get(get_url, headers=self.headers)
-                        break
+            remaining_paths.append(filepath)
 
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            # upload every document first, the parsing itself runs on the server
+            pending_jobs = {}
+            futures = {
+                executor.submit(self.submit_document, filepath): filepath
+                for filepath in remaining_paths
+            }
+            for future in as_completed(futures):
+                filepath = futures[future]
+                try:
+                    pending_jobs[future.result()] = filepath
+                except Exception as e:
+                    print(e)
+                    print("Error processing document..")
+                    error_files.append(filepath)
+
+            # poll all pending jobs together instead of waiting on one job at a time
+            idx = 0
+            while pending_jobs:
+                futures = {
+                    executor.submit(self.get_job_result, id_): id_
+                    for id_ in pending_jobs
+                }
+                for future in as_completed(futures):
+                    id_ = futures[future]
+                    try:
+                        json_result = future.result()
+                    except Exception as e:
+                        print(e)
+                        print("Error processing document..")
+                        error_files.append(pending_jobs.pop(id_))
+                        continue
+
+                    if json_result is None:
+                        continue
+
+                    filepath = pending_jobs.pop(id_)
+                    idx += 1
+                    print("({}/{}) {}".format(idx, len(remaining_paths), filepath))
+                    result_dict[filepath.name] = json_result
+                    # keep the raw response right away so a crash does not lose the finished document
+                    append_jsonl_file(self.raw_save_path, {filepath.name: json_result})
+
+                if pending_jobs:
                     time.sleep(1)
 
-                result_dict[filename] = response.json()
-            except Exception as e:
-                print(e)
-                print("Error processing document..")
-                error_files.append(filepath)
-                continue
-
         result_dict = self.post_process(result_dict)
 
-        with open(self.save_path, "w") as f:
-            json.dump(result_dict, f)
+        save_result_file(self.save_path, result_dict)
 
         for error_file in error_files:
             print(f"Error processing file: {error_file}")
@@ -184,16 +282,22 @@ if __name__ == "__main__":
     )
     args.add_argument(
         "--input_formats",
-        type=list, default=[
+        nargs="+", type=str, default=[
             ".pdf", ".jpg", ".jpeg", ".png", ".bmp", ".tiff", ".heic"
         ],
         help="Supported input file formats"
     )
+    args.add_argument(
+        "--max_workers",
+        type=int, default=8,
+        help="Number of documents to process concurrently"
+    )
     args = args.parse_args()
 
     llamaparse_inference = LlamaParseInference(
         args.save_path,
-        input_formats=args.input_formats
+        input_formats=args.input_formats,
+        max_workers=args.max_workers
     )
     llamaparse_inference.infer(args.data_path)
 
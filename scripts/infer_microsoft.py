@@ -1,11 +1,14 @@
 import os
-import json
 import argparse
 
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from azure.ai.formrecognizer import DocumentAnalysisClient
 from azure.core.credentials import AzureKeyCredential
 
-from utils import read_file_paths, validate_json_save_path, load_json_file
+from utils import (
+    read_file_paths, validate_json_save_path, load_json_file, save_result_file,
+    load_processed_keys, append_jsonl_file, load_jsonl_file
+)
 
 
 CATEGORY_MAP = {
@@ -25,12 +28,14 @@ class MicrosoftInference:
     def __init__(
         self,
         save_path,
-        input_formats=[".pdf", ".jpg", ".jpeg", ".png", ".bmp", ".tiff", ".heic"]
+        input_formats=[".pdf", ".jpg", ".jpeg", ".png", ".bmp", ".tiff", ".heic"],
+        max_workers=8
     ):
         """Initialize the MicrosoftInference class
         Args:
             save_path (str): the json path to save the results
             input_formats (list, optional): the supported file formats.
+            max_workers (int, optional): the number of documents processed concurrently.
         """
         MICROSOFT_API_KEY = os.getenv("MICROSOFT_API_KEY") or ""
         MICROSOFT_ENDPOINT = os.getenv("MICROSOFT_ENDPOINT") or ""
@@ -44,9 +49,21 @@ class MicrosoftInference:
 
         validate_json_save_path(save_path)
         self.save_path = save_path
-        self.processed_data = load_json_file(save_path)
+        # skipping documents only needs their names, the previous results
+        # themselves are loaded once the new ones are saved
+        self.processed_names = load_processed_keys(save_path)
+        self._processed_data = None
+        self.raw_save_path = os.path.splitext(save_path)[0] + "_raw.jsonl"
 
         self.formats = input_formats
+        self.max_workers = max_workers
+
+    @property
+    def processed_data(self):
+        # the previous results are only needed when saving, not to decide what to skip
+        if self._processed_data is None:
+            self._processed_data = load_json_file(self.save_path)
+        return self._processed_data
 
     def post_process(self, data):
         processed_dict = {}
@@ -63,8 +80,7 @@ class MicrosoftInference:
                 category = CATEGORY_MAP.get(category, "paragraph")
 
                 transcription = par_elem["content"]
-                coord = [[pt["x"], pt["y"]] for pt in par_elem["bounding_regions"][0]["polygon"]]
-                xy_coord = [{"x": x, "y": y} for x, y in coord]
+                xy_coord = [{"x": pt["x"], "y": pt["y"]} for pt in par_elem["bounding_regions"][0]["polygon"]]
 
                 data_dict = {
                     "coordinates": xy_coord,
@@ -80,19 +96,14 @@ class MicrosoftInference:
 
                 id_counter += 1
 
-            html_transcription = ""
             for table_elem in output_data["tables"]:
-                coord = [[pt["x"], pt["y"]] for pt in table_elem["bounding_regions"][0]["polygon"]]
-                xy_coord = [{"x": x, "y": y} for x, y in coord]
+                xy_coord = [{"x": pt["x"], "y": pt["y"]} for pt in table_elem["bounding_regions"][0]["polygon"]]
 
                 category = "table"
 
-                html_transcription += "<table>"
-
                 # Create a matrix to represent the table
-                table_matrix = [
-                    ["" for _ in range(table_elem["column_count"])] for _ in range(table_elem["row_count"])
-                ]
+                column_count = table_elem["column_count"]
+                table_matrix = [[""] * column_count for _ in range(table_elem["row_count"])]
 
                 # Fill the matrix with table data
                 for cell in table_elem["cells"]:
@@ -102,24 +113,26 @@ class MicrosoftInference:
                     colspan = cell.get("column_span", 1)
                     content = cell["content"]
 
-                    # Insert content into the matrix, handle rowspan and colspan
-                    for r in range(row, row + rowspan):
-                        for c in range(col, col + colspan):
-                            if r == row and c == col:
-                                table_matrix[r][c] = f"<td rowspan='{rowspan}' colspan='{colspan}'>{content}</td>"
-                            else:
-                                # Mark cells covered by rowspan or colspan
-                                table_matrix[r][c] = None
+                    # Mark cells covered by rowspan or colspan, one slice per spanned row
+                    if rowspan > 1 or colspan > 1:
+                        for r in range(row, row + rowspan):
+                            table_matrix[r][col:col + colspan] = [None] * colspan
+
+                    # span attributes are only written when they differ from the default of 1
+                    if rowspan == 1 and colspan == 1:
+                        table_matrix[row][col] = "<td>%s</td>" % content
+                    else:
+                        table_matrix[row][col] = "<td rowspan='%d' colspan='%d'>%s</td>" % (rowspan, colspan, content)
 
                 # Generate HTML from the matrix
+                html_parts = ["<table>"]
                 for row in table_matrix:
-                    html_transcription += "<tr>"
-                    for cell in row:
-                        if cell is not None:
-                            html_transcription += f"{cell}"
-                    html_transcription += "</tr>"
+                    html_parts.append("<tr>")
+                    html_parts.extend(cell for cell in row if cell is not None)
+                    html_parts.append("</tr>")
+                html_parts.append("</table>")
 
-                html_transcription += "</table>"
+                html_transcription = "".join(html_parts)
 
                 data_dict = {
                     "coordinates": xy_coord,
@@ -135,12 +148,20 @@ class MicrosoftInference:
 
                 id_counter += 1
 
-        for key in self.processed_data:
-            processed_dict[key] = self.processed_data[key]
+        processed_dict.update(self.processed_data)
 
         return processed_dict
 
 
+    def process_document(self, filepath):
+        with open(filepath, "rb") as input_data:
+            poller = self.document_analysis_client.begin_analyze_document(
+                "prebuilt-layout", document=input_data
+            )
+            result = poller.result()
+
+        return result.to_dict()
+
     def infer(self, file_path):
         """Infer the layout of the documents in the given file path
         Args:
@@ -150,36 +171,56 @@ class MicrosoftInference:
 
         error_files = []
 
-        result_dict = {}
-        for idx, filepath in enumerate(paths):
-            print("({}/{}) {}".format(idx+1, len(paths), filepath))
-
+        needed_paths = []
+        for filepath in paths:
             filename = filepath.name
-            if filename in self.processed_data.keys():
+            if filename in self.processed_names:
                 print(f"'{filename}' is already in the loaded dictionary. Skipping this sample")
                 continue
 
-            input_data = open(filepath, "rb")
+            needed_paths.append(filepath)
 
-            try:
-                poller = self.document_analysis_client.begin_analyze_document(
-                    "prebuilt-layout", document=input_data
-                )
-                result = poller.result()
+        # raw responses of the needed documents saved by an earlier, possibly interrupted, run
+        raw_results = load_jsonl_file(
+            self.raw_save_path, names={filepath.name for filepath in needed_paths}
+        )
 
-                json_result = result.to_dict()
-            except Exception as e:
-                print(e)
-                print("Error processing document..")
-                error_files.append(filepath)
+        result_dict = {}
+        remaining_paths = []
+        for filepath in needed_paths:
+            filename = filepath.name
+            if filename in raw_results:
+                print(f"'{filename}' already has a saved API response. Reusing it")
+                result_dict[filename] = raw_results[filename]
                 continue
 
-            result_dict[filename] = json_result
+            remaining_paths.append(filepath)
+
+        # documents are processed concurrently since each one mostly waits on the API
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {
+                executor.submit(self.process_document, filepath): filepath
+                for filepath in remaining_paths
+            }
+            for idx, future in enumerate(as_completed(futures)):
+                filepath = futures[future]
+                print("({}/{}) {}".format(idx+1, len(futures), filepath))
+
+                try:
+                    json_result = future.result()
+                except Exception as e:
+                    print(e)
+                    print("Error processing document..")
+                    error_files.append(filepath)
+                    continue
+
+                result_dict[filepath.name] = json_result
+                # keep the raw response right away so a crash does not lose the finished document
+                append_jsonl_file(self.raw_save_path, {filepath.name: json_result})
 
         result_dict = self.post_process(result_dict)
 
-        with open(self.save_path, "w") as f:
-            json.dump(result_dict, f)
+        save_result_file(self.save_path, result_dict)
 
         for error_file in error_files:
             print(f"Error processing file: {error_file}")
@@ -203,15 +244,21 @@ if __name__ == "__main__":
     )
     args.add_argument(
         "--input_formats",
-        type=list, default=[
+        nargs="+", type=str, default=[
             ".pdf", ".jpg", ".jpeg", ".png", ".bmp", ".tiff", ".heic"
         ],
         help="Supported input file formats"
     )
+    args.add_argument(
+        "--max_workers",
+        type=int, default=8,
+        help="Number of documents to process concurrently"
+    )
     args = args.parse_args()
 
     microsoft_inference = MicrosoftInference(
         args.save_path,
-        input_formats=args.input_formats
+        input_formats=args.input_formats,
+        max_workers=args.max_workers
     )
     microsoft_inference.infer(args.data_path)
@@ -1,13 +1,16 @@
 import os
 import time
-import json
 import argparse
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import unstructured_client
 from unstructured_client.models import operations, shared
 
-from utils import read_file_paths, validate_json_save_path, load_json_file
+from utils import (
+    read_file_paths, validate_json_save_path, load_json_file, save_result_file,
+    load_processed_keys, append_jsonl_file, load_jsonl_file
+)
 
 
 CATEGORY_MAP = {
@@ -32,14 +35,17 @@ class UnstructuredInference:
     def __init__(
         self,
         save_path,
-        input_formats=[".pdf", ".jpg", ".jpeg", ".png", ".bmp", ".tiff", ".heic"]
+        input_formats=[".pdf", ".jpg", ".jpeg", ".png", ".bmp", ".tiff", ".heic"],
+        max_workers=8
     ):
         """Initialize the UnstructuredInference class
         Args:
             save_path (str): the json path to save the results
             input_formats (list, optional): the supported file formats.
+            max_workers (int, optional): the number of documents processed concurrently.
         """
         self.formats = input_formats
+        self.max_workers = max_workers
 
         self.api_key = os.getenv("UNSTRUCTURED_API_KEY") or ""
         self.url = os.getenv("UNSTRUCTURED_URL") or ""
@@ -54,13 +60,24 @@ class UnstructuredInference:
         # create save basepath
         validate_json_save_path(save_path)
         self.save_path = save_path
-        self.processed_data = load_json_file(save_path)
+        # skipping documents only needs their names, the previous results
+        # themselves are loaded once the new ones are saved
+        self.processed_names = load_processed_keys(save_path)
+        self._processed_data = None
+        self.raw_save_path = os.path.splitext(save_path)[0] + "_raw.jsonl"
 
         self.client = unstructured_client.UnstructuredClient(
             api_key_auth=self.api_key,
             server_url=self.url,
         )
 
+    @property
+    def processed_data(self):
+        # the previous results are only needed when saving, not to decide what to skip
+        if self._processed_data is None:
+            self._processed_data = load_json_file(self.save_path)
+        return self._processed_data
+
     def post_process(self, data):
         processed_dict = {}
         for input_key in data.keys():
@@ -96,11 +113,32 @@ class UnstructuredInference:
 
                 id_counter += 1
 
-        for key in self.processed_data:
-            processed_dict[key] = self.processed_data[key]
+        processed_dict.update(self.processed_data)
 
         return processed_dict
 
+    def process_document(self, filepath):
+        with open(filepath, "rb") as f:
+            data = f.read()
+
+        req = operations.PartitionRequest(
+            partition_parameters=shared.PartitionParameters(
+                files=shared.Files(
+                    content=data,
+                    file_name=str(filepath),
+                ),
+                # --- Other partition parameters ---
+                strategy=shared.Strategy.HI_RES,
+                pdf_infer_table_structure=self.infer_table_structure,
+                coordinates=self.get_coordinates,
+                languages=self.languages,
+            ),
+        )
+
+        res = self.client.general.partition(request=req)
+
+        return res.elements
+
     def infer(self, file_path):
         """Infer the layout of the documents in the given file path
         Args:
@@ -110,46 +148,56 @@ class UnstructuredInference:
 
         error_files = []
 
-        result_dict = {}
+        needed_paths = []
         for filepath in paths:
-            print("({}/{}) Processing {}".format(paths.index(filepath) + 1, len(paths), filepath))
             filename = filepath.name
-            if filename in self.processed_data.keys():
+            if filename in self.processed_names:
                 print(f"'{filename}' is already in the loaded dictionary. Skipping this sample")
                 continue
 
-            with open(filepath, "rb") as f:
-                data = f.read()
-
-            req = operations.PartitionRequest(
-                partition_parameters=shared.PartitionParameters(
-                    files=shared.Files(
-                        content=data,
-                        file_name=str(filepath),
-                    ),
-                    # --- Other partition parameters ---
-                    strategy=shared.Strategy.HI_RES,
-                    pdf_infer_table_structure=self.infer_table_structure,
-                    coordinates=self.get_coordinates,
-                    languages=self.languages,
-                ),
-            )
-
-            try:
-                res = self.client.general.partition(request=req)
-                elements = res.elements
-            except Exception as e:
-                print(e)
-                print("Error processing document..")
-                error_files.append(filepath)
+            needed_paths.append(filepath)
+
+        # raw responses of the needed documents saved by an earlier, possibly interrupted, run
+        raw_results = load_jsonl_file(
+            self.raw_save_path, names={filepath.name for filepath in needed_paths}
+        )
+
+        result_dict = {}
+        remaining_paths = []
+        for filepath in needed_paths:
+            filename = filepath.name
+            if filename in raw_results:
+                print(f"'{filename}' already has a saved API response. Reusing it")
+                result_dict[filename] = raw_results[filename]
                 continue
 
-            result_dict[filename] = elements
+            remaining_paths.append(filepath)
+
+        # documents are processed concurrently since each one mostly waits on the API
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {
+                executor.submit(self.process_document, filepath): filepath
+                for filepath in remaining_paths
+            }
+            for idx, future in enumerate(as_completed(futures)):
+                filepath = futures[future]
+                print("({}/{}) {}".format(idx+1, len(futures), filepath))
+
+                try:
+                    elements = future.result()
+                except Exception as e:
+                    print(e)
+                    print("Error processing document..")
+                    error_files.append(filepath)
+                    continue
+
+                result_dict[filepath.name] = elements
+                # keep the raw response right away so a crash does not lose the finished document
+                append_jsonl_file(self.raw_save_path, {filepath.name: elements})
 
         result_dict = self.post_process(result_dict)
 
-        with open(self.save_path, "w") as f:
-            json.dump(result_dict, f)
+        save_result_file(self.save_path, result_dict)
 
         for error_file in error_files:
             print(f"Error processing file: {error_file}")
@@ -173,16 +221,22 @@ if __name__ == "__main__":
     )
     args.add_argument(
         "--input_formats",
-        type=list, default=[
+        nargs="+", type=str, default=[
             ".pdf", ".jpg", ".jpeg", ".png", ".bmp", ".tiff", ".heic"
         ],
         help="Supported input file formats"
     )
+    args.add_argument(
+        "--max_workers",
+        type=int, default=8,
+        help="Number of documents to process concurrently"
+    )
     args = args.parse_args()
 
     unstructured_inference = UnstructuredInference(
         args.save_path,
-        input_formats=args.input_formats
+        input_formats=args.input_formats,
+        max_workers=args.max_workers
     )
     unstructured_inference.infer(args.data_path)
 
@@ -1,11 +1,15 @@
 import os
 import sys
-import json
 import requests
+from requests.adapters import HTTPAdapter
 import argparse
 
 from pathlib import Path
-from utils import read_file_paths, validate_json_save_path, load_json_file
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from utils import (
+    read_file_paths, validate_json_save_path, load_json_file, save_result_file,
+    load_processed_keys, append_jsonl_file, load_jsonl_file
+)
 
 
 class UpstageInference:
@@ -15,6 +19,7 @@ class UpstageInference:
         input_formats=[".pdf", ".jpg", ".jpeg", ".png", ".bmp", ".tiff", ".heic"],
         output_formats=["text", "html", "markdown"],
         model_name="document-parse-240910",
+        max_workers=8,
     ):
         """Initialize the UpstageInference class
         Args:
@@ -22,6 +27,7 @@ class UpstageInference:
             input_formats (list, optional): the supported input file formats.
             output_formats (list, optional): the supported output formats.
             model_name (str, optional): the model name. Defaults to "document-parse-240910".
+            max_workers (int, optional): the number of documents processed concurrently.
         """
 
         self.endpoint = os.getenv("UPSTAGE_ENDPOINT", "")
@@ -32,10 +38,22 @@ class UpstageInference:
 
         validate_json_save_path(save_path)
         self.save_path = save_path
-        self.processed_data = load_json_file(save_path)
+        # skipping documents only needs their names, the previous results
+        # themselves are loaded once the new ones are saved
+        self.processed_names = load_processed_keys(save_path)
+        self._processed_data = None
+        self.raw_save_path = os.path.splitext(save_path)[0] + "_raw.jsonl"
 
         self.input_formats = input_formats
         self.output_formats = output_formats
+        self.max_workers = max_workers
+
+        # the session shares pooled keep-alive connections between requests,
+        # sized so that every worker can keep its own connection open
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
 
         self.headers = {
             "Authorization": f"Bearer {self.api_key}",
@@ -47,6 +65,27 @@ class UpstageInference:
             "output_formats": f"{self.output_formats}"
         }
 
+    @property
+    def processed_data(self):
+        # the previous results are only needed when saving, not to decide what to skip
+        if self._processed_data is None:
+            self._processed_data = load_json_file(self.save_path)
+        return self._processed_data
+
+    def process_document(self, filepath) -> dict:
+        # The API does not support files exceeding 50MB
+        # or containing more than 100 pages.
+        with open(filepath, "rb") as document:
+            response = self.session.post(
+                self.endpoint,
+                headers=self.headers,
+                files={"document": document},
+                data=self.data
+            )
+        response.raise_for_status()
+
+        return response.json()
+
     def infer(self, file_path) -> None:
         """Infer the layout of the documents in the given file path
         Args:
@@ -57,43 +96,56 @@ class UpstageInference:
 
         error_files = []
 
-        result_dict = {}
-        for idx, filepath in enumerate(paths):
-            print("({}/{}) {}".format(idx+1, len(paths), filepath))
-
+        needed_paths = []
+        for filepath in paths:
             filename = Path(filepath).name
-            if filename in self.processed_data.keys():
+            if filename in self.processed_names:
                 print(f"'{filename}' is already in the loaded dictionary. Skipping this sample")
                 continue
 
-            files = {
-                "document": open(filepath, "rb"),
-            }
+            needed_paths.append(filepath)
+
+        # raw responses of the needed documents saved by an earlier, possibly interrupted, run
+        raw_results = load_jsonl_file(
+            self.raw_save_path, names={filepath.name for filepath in needed_paths}
+        )
 
-            try:
-                # The API does not support files exceeding 50MB
-                # or containing more than 100 pages.
-                response = requests.post(
-                    self.endpoint,
-                    headers=self.headers,
-                    files=files,
-                    data=self.data
-                )
-                json_result = response.json()
-
-                result_dict[filename] = json_result
-
-            except Exception as e:
-                print(e)
-                print("Error processing document..")
-                error_files.append(filepath)
+        result_dict = {}
+        remaining_paths = []
+        for filepath in needed_paths:
+            filename = filepath.name
+            if filename in raw_results:
+                print(f"'{filename}' already has a saved API response. Reusing it")
+                result_dict[filename] = raw_results[filename]
                 continue
 
-        for key in self.processed_data:
-            result_dict[key] = self.processed_data[key]
+            remaining_paths.append(filepath)
 
-        with open(self.save_path, "w", encoding="utf-8") as f:
-            json.dump(result_dict, f, ensure_ascii=False, indent=4)
+        # documents are processed concurrently since each one mostly waits on the API
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {
+                executor.submit(self.process_document, filepath): filepath
+                for filepath in remaining_paths
+            }
+            for idx, future in enumerate(as_completed(futures)):
+                filepath = futures[future]
+                print("({}/{}) {}".format(idx+1, len(futures), filepath))
+
+                try:
+                    json_result = future.result()
+                except Exception as e:
+                    print(e)
+                    print("Error processing document..")
+                    error_files.append(filepath)
+                    continue
+
+                result_dict[filepath.name] = json_result
+                # keep the raw response right away so a crash does not lose the finished document
+                append_jsonl_file(self.raw_save_path, {filepath.name: json_result})
+
+        result_dict.update(self.processed_data)
+
+        save_result_file(self.save_path, result_dict, indent=True)
 
         for error_file in error_files:
             print(f"Error processing file: {error_file}")
@@ -117,14 +169,19 @@ if __name__ == "__main__":
     )
     args.add_argument(
         "--input_formats",
-        type=list, default=[
+        nargs="+", type=str, default=[
             ".pdf", ".jpg", ".jpeg", ".png", ".bmp", ".tiff", ".heic"
         ],
         help="Supported input file formats"
     )
+    args.add_argument(
+        "--max_workers",
+        type=int, default=8,
+        help="Number of documents to process concurrently"
+    )
     args.add_argument(
         "--output_formats",
-        type=list, default=["text", "html", "markdown"],
+        nargs="+", type=str, default=["text", "html", "markdown"],
         help="Output formats supported by the API"
     )
     args = args.parse_args()
@@ -132,6 +189,7 @@ if __name__ == "__main__":
     upstage_inference = UpstageInference(
         args.save_path,
         input_formats=args.input_formats,
-        output_formats=args.output_formats
+        output_formats=args.output_formats,
+        max_workers=args.max_workers
     )
     upstage_inference.infer(args.data_path)
@@ -1,8 +1,18 @@
 import os
 import json
+import hashlib
+import threading
 from pathlib import Path
 from typing import List
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+JSON_DECODER = json.JSONDecoder()
+
 
 def read_file_paths(path: str, supported_formats: List[str] = [".jpg"]) -> List[str]:
     """Read files in a directory and return their content as a list of strings
@@ -24,18 +34,31 @@ def read_file_paths(path: str, supported_formats: List[str] = [".jpg"]) -> List[
     if not path.exists() or not path.is_dir():
         raise FileNotFoundError(f"Directory {path} not found")
 
-    # get the list of files in the directory
-    file_paths = [file for file in path.iterdir() if file.is_file()]
+    if not supported_formats:
+        return []
 
-    # filter file paths based on the supported formats
-    if supported_formats:
-        file_paths = [file for file in file_paths if file.suffix in supported_formats]
-    else:
-        file_paths = []
+    formats = frozenset(supported_formats)
+
+    # scandir entries cache the file type, so filtering does not stat every file
+    file_paths = []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_file() and os.path.splitext(entry.name)[1] in formats:
+                file_paths.append(path / entry.name)
 
     return file_paths
 
 
+def compute_file_hash(path: str, chunk_size: int = 1 << 20) -> str:
+    # Hash the file content in chunks so large documents are never fully loaded
+    file_hash = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(chunk_size), b""):
+            file_hash.update(chunk)
+
+    return file_hash.hexdigest()
+
+
 def validate_json_save_path(path: str) -> None:
     # Check if the path ends with .json
     if not path.endswith('.json'):
@@ -54,11 +77,129 @@ def load_json_file(path: str) -> dict:
     if os.path.isfile(path):
         try:
             # Open and load the JSON file
-            with open(path, 'r') as file:
-                return json.load(file)
+            with open(path, 'rb') as file:
+                return parse_json(file.read())
         except (json.JSONDecodeError, OSError) as e:
             print(f"Error loading JSON from '{path}': {e}")
             return {}
     else:
         # If the file does not exist, return an empty dictionary
         return {}
+
+
+def parse_json(text) -> dict:
+    # Use orjson when available, it is considerably faster on large payloads
+    if orjson is not None:
+        return orjson.loads(text)
+    return json.loads(text)
+
+
+def write_file_atomic(path: str, content: bytes) -> None:
+    # Write to a temporary file next to the target and move it into place,
+    # so an error or interruption never leaves a truncated file behind
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp_path, "wb") as file:
+            file.write(content)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def save_json_file(path: str, data: dict, indent: bool = False) -> None:
+    # Serialize before touching the file, a failure leaves the previous content intact
+    if orjson is not None:
+        option = orjson.OPT_NON_STR_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        content = orjson.dumps(data, option=option)
+    else:
+        content = json.dumps(data, ensure_ascii=False, indent=2 if indent else None).encode("utf-8")
+
+    write_file_atomic(path, content)
+
+
+def save_result_file(path: str, data: dict, indent: bool = False) -> None:
+    save_json_file(path, data, indent=indent)
+
+    # List the saved file names in a sidecar, so a restart does not parse all results.
+    # The sidecar is written last and records the result file it describes, so it is
+    # only trusted while that exact file is still in place.
+    stat = os.stat(path)
+    sidecar = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "keys": list(data)}
+    write_file_atomic(path + ".keys", json.dumps(sidecar, ensure_ascii=False).encode("utf-8"))
+
+
+def load_processed_keys(path: str) -> frozenset:
+    # Read the file names already in the result file, preferring the sidecar
+    keys_path = path + ".keys"
+    if os.path.isfile(keys_path) and os.path.isfile(path):
+        try:
+            with open(keys_path, "rb") as file:
+                sidecar = parse_json(file.read())
+            stat = os.stat(path)
+            if stat.st_size > 0 and sidecar["size"] == stat.st_size and \
+                    sidecar["mtime_ns"] == stat.st_mtime_ns:
+                return frozenset(sidecar["keys"])
+        except (ValueError, KeyError, TypeError, OSError) as e:
+            print(f"Ignoring invalid key sidecar '{keys_path}': {e}")
+
+    # the sidecar is missing or does not match the result file
+    return frozenset(load_json_file(path))
+
+
+def append_jsonl_file(path: str, record: dict) -> None:
+    # Append a single record per line, so completed work is kept if the run crashes
+    if orjson is not None:
+        line = orjson.dumps(record, option=orjson.OPT_NON_STR_KEYS) + b"\n"
+    else:
+        line = (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+
+    with open(path, "a+b") as file:
+        # start on a new line if an interrupted run left a partial record behind
+        if file.tell() > 0:
+            file.seek(-1, os.SEEK_END)
+            if file.read(1) != b"\n":
+                line = b"\n" + line
+        file.write(line)
+
+
+def load_jsonl_file(path: str, names: set = None) -> dict:
+    # Merge the records of a JSON Lines file, later records overwrite earlier ones.
+    # With names given, only records for those keys are parsed and kept.
+    records = {}
+    if names is not None and not names:
+        return records
+
+    if os.path.isfile(path):
+        with open(path, "rb") as file:
+            for line in file:
+                if not line.strip():
+                    continue
+                if names is not None and read_jsonl_key(line) not in names:
+                    continue
+                try:
+                    record = parse_json(line)
+                except ValueError as e:
+                    # the last line may be incomplete if a previous run was interrupted
+                    print(f"Skipping invalid line in '{path}': {e}")
+                    continue
+                if names is not None:
+                    record = {key: value for key, value in record.items() if key in names}
+                records.update(record)
+
+    return records
+
+
+def read_jsonl_key(line: bytes):
+    # Decode only the first key of a record, so unneeded records are never fully parsed
+    try:
+        text = line.decode("utf-8").lstrip()
+        if not text.startswith("{"):
+            return None
+        key, _ = JSON_DECODER.raw_decode(text, text.index('"'))
+    except ValueError:
+        return None
+    return key if isinstance(key, str) else None
@@ -1,27 +1,51 @@
-from rapidfuzz import fuzz
+import numpy as np
+
+from rapidfuzz.distance import Indel
+from rapidfuzz.process import cpdist
+
+# Extracted gt texts, reused when one gt is evaluated against several predictions.
+# Each entry keeps its gt data so that a recycled id() never matches another object.
+_GT_TEXT_CACHE = {}
+_GT_TEXT_CACHE_SIZE = 4096
+
+# Lowercased category names, documents only use a handful of distinct categories
+_LOWER_CACHE = {}
+
+
+def _lower(string : str) -> str:
+    lowered = _LOWER_CACHE.get(string)
+    if lowered is None:
+        lowered = _LOWER_CACHE[string] = string.lower()
+    return lowered
+
 
 def calc_nid(
-    gt_text : list,
-    pred_text : list,
+    gt_text : str,
+    pred_text : str,
+    score_cutoff : float = 0,
 ) -> float:
     """Calculate the Normalized InDel score between the gt and pred text.
 
     Args:
         gt_text (str): The string of gt text to compare.
         pred_text (str): The string of pred text to compare.
+        score_cutoff (float): Scores below this value are returned as 0,
+            which lets the comparison stop early.
 
     Returns:
-        float: The nid score between gt and pred text.
+        float: The nid score between gt and pred text, between 0 and 100.
     """
 
-    # if gt and pred is empty, return 1
+    # if gt and pred is empty, they match perfectly
     if len(gt_text) == 0 and len(pred_text) == 0:
-        score = 1
+        score = 100
     # if pred is empty while gt is not, return 0
     elif len(gt_text) > 0 and len(pred_text) == 0:
         score = 0
     else:
-        score = fuzz.ratio(gt_text, pred_text)
+        score = Indel.normalized_similarity(
+            gt_text, pred_text, score_cutoff=score_cutoff / 100
+        ) * 100
 
     return score
 
@@ -42,21 +66,53 @@ def extract_text(
         str: The concatenated text extracted from the data.
     """
 
-    ignore_classes = [x.lower() for x in ignore_classes]
+    ignore_classes = frozenset(_lower(x) for x in ignore_classes)
 
-    concatenated_text = ""
+    concatenated_text = "".join([
+        elem["content"]["text"] + ' '
+        for elem in data["elements"]
+        if _lower(elem["category"]) not in ignore_classes
+    ])
 
-    for elem in data["elements"]:
-        if elem["category"].lower() in ignore_classes:
-            continue
+    # remove unwanted strings, in a single pass if they are all single characters
+    if all(len(string) == 1 for string in strings_to_remove):
+        concatenated_text = concatenated_text.translate(
+            str.maketrans('', '', ''.join(strings_to_remove))
+        )
+    else:
+        for string in strings_to_remove:
+            concatenated_text = concatenated_text.replace(string, '')
 
-        concatenated_text += elem["content"]["text"] + ' '
+    return concatenated_text
 
-    # remove unwanted strings
-    for string in strings_to_remove:
-        concatenated_text = concatenated_text.replace(string, '')
 
-    return concatenated_text
+def extract_gt_text(
+    data : dict,
+    ignore_classes : list = [],
+) -> str:
+    """Extract text from the gt data, reusing the result of previous calls.
+
+    Args:
+        data (dict): The gt data to extract text from.
+        ignore_classes (list): A list of classes to ignore during extraction.
+
+    Returns:
+        str: The concatenated text extracted from the data.
+    """
+
+    key = (id(data), frozenset(_lower(x) for x in ignore_classes))
+
+    cached = _GT_TEXT_CACHE.get(key)
+    if cached is not None and cached[0] is data:
+        return cached[1]
+
+    if len(_GT_TEXT_CACHE) >= _GT_TEXT_CACHE_SIZE:
+        _GT_TEXT_CACHE.clear()
+
+    text = extract_text(data, ignore_classes)
+    _GT_TEXT_CACHE[key] = (data, text)
+
+    return text
 
 
 def evaluate_layout(
@@ -74,19 +130,23 @@ def evaluate_layout(
     Returns:
         float: The layout evaluation score.
     """
-    scores = []
+    gt_texts = []
+    pred_texts = []
     for image_key in gt.keys():
         gt_data = gt.get(image_key)
         pred_data = pred.get(image_key)
 
-        gt_text = extract_text(gt_data, ignore_classes)
-        pred_text = extract_text(pred_data, ignore_classes)
-
-        score = calc_nid(gt_text, pred_text)
+        gt_texts.append(extract_gt_text(gt_data, ignore_classes))
+        pred_texts.append(extract_text(pred_data, ignore_classes))
 
-        scores.append(score)
+    if len(gt_texts) > 0:
+        # score every gt/pred pair in C, spread over all available cores,
+        # this gives the same scores as calc_nid on each pair
+        scores = (cpdist(
+            gt_texts, pred_texts,
+            scorer=Indel.normalized_similarity, dtype=np.float64, workers=-1
+        ) * 100).tolist()
 
-    if len(scores) > 0:
         avg_score = sum(scores) / (len(scores) * 100)
     else:
         avg_score = 0
@@ -6,12 +6,52 @@ A slight modification has been added to the code to improve the evaluation proce
 """
 
 import re
-import distance
 
 from lxml import etree, html
-from collections import deque
+from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor
 from apted.helpers import Tree
 from apted import APTED, Config
+from rapidfuzz.distance import Levenshtein
+
+
+# opening and closing thead and tbody tags, removed before evaluation
+THEAD_TBODY_PATTERN = re.compile(r'</?t(?:head|body)>')
+
+# parser and compiled xpath shared by all evaluations, they cannot be pickled
+# so they are kept per process instead of on the evaluator
+HTML_PARSER = html.HTMLParser(remove_comments=True, encoding='utf-8')
+BODY_TABLE_XPATH = etree.XPath('body/table')
+
+
+# opening and closing tokens of html tags, tables only use a handful of tags
+OPEN_TAG_TOKENS = {}
+CLOSE_TAG_TOKENS = {}
+
+
+def open_tag_token(tag):
+    token = OPEN_TAG_TOKENS.get(tag)
+    if token is None:
+        token = OPEN_TAG_TOKENS[tag] = '<%s>' % tag
+    return token
+
+
+def close_tag_token(tag):
+    token = CLOSE_TAG_TOKENS.get(tag)
+    if token is None:
+        token = CLOSE_TAG_TOKENS[tag] = '</%s>' % tag
+    return token
+
+
+# lowercased element categories, documents only use a handful of distinct categories
+LOWER_CATEGORIES = {}
+
+
+def lower_category(category):
+    lowered = LOWER_CATEGORIES.get(category)
+    if lowered is None:
+        lowered = LOWER_CATEGORIES[category] = category.lower()
+    return lowered
 
 
 class TableTree(Tree):
@@ -37,6 +77,10 @@ class TableTree(Tree):
 
 class CustomConfig(Config):
     """Custom Configuration for APTED"""
+    def __init__(self):
+        # APTED renames the same node pairs many times, cache the cell distances
+        self.rename_cache = {}
+
     @staticmethod
     def maximum(*sequences):
         """Get maximum possible value"""
@@ -44,7 +88,10 @@ class CustomConfig(Config):
 
     def normalized_distance(self, *sequences):
         """Get distance from 0 to 1"""
-        return float(distance.levenshtein(*sequences)) / self.maximum(*sequences)
+        # a string cell is compared with a token list cell as a list of characters
+        if len(set(map(type, sequences))) > 1:
+            sequences = [list(sequence) for sequence in sequences]
+        return float(Levenshtein.distance(*sequences)) / self.maximum(*sequences)
 
     def rename(self, node1, node2):
         """Compares attributes of trees"""
@@ -54,9 +101,24 @@ class CustomConfig(Config):
             return 1.
         if node1.tag == 'td':
             if node1.content or node2.content:
-                return self.normalized_distance(
-                    node1.content, node2.content
-                )
+                key = (id(node1), id(node2))
+                cost = self.rename_cache.get(key)
+                if cost is None:
+                    cost = self.rename_cache[key] = self.normalized_distance(
+                        node1.content, node2.content
+                    )
+                return cost
+        return 0.
+
+
+class StructureOnlyConfig(CustomConfig):
+    """Configuration for APTED that ignores the cell contents"""
+    def rename(self, node1, node2):
+        """Compares attributes of trees, except for the cell contents"""
+        if (node1.tag != node2.tag) or \
+                (node1.colspan != node2.colspan) or \
+                (node1.rowspan != node2.rowspan):
+            return 1.
         return 0.
 
 
@@ -69,69 +131,117 @@ class TEDSEvaluator(object):
         self.structure_only = structure_only
         self.n_jobs = n_jobs
         self.ignore_nodes = ignore_nodes
-        self.__tokens__ = []
 
     def tokenize(self, node):
         """Tokenizes table cells"""
-        self.__tokens__.append('<%s>' % node.tag)
-        if node.text is not None:
-            self.__tokens__ += list(node.text)
-        for n in node.getchildren():
-            self.tokenize(n)
-        if node.tag != 'unk':
-            self.__tokens__.append('</%s>' % node.tag)
-        if node.tag != 'td' and node.tail is not None:
-            self.__tokens__ += list(node.tail)
+        tokens = []
+        # walk the cell with a stack, each node is pushed again to emit its closing tokens
+        stack = [(node, False)]
+        while stack:
+            node, closing = stack.pop()
+            if closing:
+                if node.tag != 'unk':
+                    tokens.append(close_tag_token(node.tag))
+                if node.tag != 'td' and node.tail is not None:
+                    tokens.extend(node.tail)
+                continue
+            tokens.append(open_tag_token(node.tag))
+            if node.text is not None:
+                tokens.extend(node.text)
+            stack.append((node, True))
+            stack.extend((n, False) for n in reversed(node.getchildren()))
+        return tokens
 
     def load_html_tree(self, node, parent=None):
         """Converts HTML tree to the format required by apted"""
-        global __tokens__
-        if node.tag == 'td':
-            if self.structure_only:
-                cell = []
+        root = None
+        stack = [(node, parent)]
+        while stack:
+            node, parent = stack.pop()
+            if node.tag == 'td':
+                if self.structure_only:
+                    cell = []
+                else:
+                    cell = self.tokenize(node)[1:-1]
+                    # plain text cells are kept as strings, which rapidfuzz compares fastest,
+                    # cells with inline tags stay token lists so that a tag is a single token
+                    text = ''.join(cell)
+                    if len(text) == len(cell):
+                        cell = text
+                new_node = TableTree(
+                    node.tag,
+                    int(node.attrib.get('colspan', '1')),
+                    int(node.attrib.get('rowspan', '1')),
+                    cell
+                )
             else:
-                self.__tokens__ = []
-                self.tokenize(node)
-                cell = self.__tokens__[1:-1].copy()
-            new_node = TableTree(
-                node.tag,
-                int(node.attrib.get('colspan', '1')),
-                int(node.attrib.get('rowspan', '1')),
-                cell, *deque()
-            )
-        else:
-            new_node = TableTree(node.tag, None, None, None, *deque())
-        if parent is not None:
-            parent.children.append(new_node)
-        if node.tag != 'td':
-            for n in node.getchildren():
-                self.load_html_tree(n, new_node)
-        if parent is None:
-            return new_node
-
-    def evaluate(self, pred, true):
-        """Computes TEDS score between the prediction and the ground truth of a given sample"""
-        if (not pred) or (not true):
-            return 0.0
-        parser = html.HTMLParser(remove_comments=True, encoding='utf-8')
-        pred = html.fromstring(pred, parser=parser)
-        true = html.fromstring(true, parser=parser)
+                new_node = TableTree(node.tag, None, None, None)
+            if parent is not None:
+                parent.children.append(new_node)
+            else:
+                root = new_node
+            if node.tag != 'td':
+                # children are pushed in reverse so they are appended in document order
+                stack.extend((n, new_node) for n in reversed(node.getchildren()))
+        return root
 
-        if pred.xpath('body/table') and true.xpath('body/table'):
-            pred = pred.xpath('body/table')[0]
-            true = true.xpath('body/table')[0]
+    @staticmethod
+    def count_descendants(node):
+        """Counts the descendant elements of a node, same as len(node.xpath('.//*'))"""
+        # iter() includes the node itself, but not comments or processing instructions
+        return sum(1 for _ in node.iter(etree.Element)) - 1
+
+    def load_trees(self, pred, true):
+        """Parses the prediction and the ground truth into trees for apted.
+        Returns None if either of them does not contain a table"""
+        pred = html.fromstring(pred, parser=HTML_PARSER)
+        true = html.fromstring(true, parser=HTML_PARSER)
+
+        pred_tables = BODY_TABLE_XPATH(pred)
+        true_tables = BODY_TABLE_XPATH(true)
+
+        if pred_tables and true_tables:
+            pred = pred_tables[0]
+            true = true_tables[0]
             if self.ignore_nodes:
                 etree.strip_tags(pred, *self.ignore_nodes)
                 etree.strip_tags(true, *self.ignore_nodes)
-            n_nodes_pred = len(pred.xpath('.//*'))
-            n_nodes_true = len(true.xpath('.//*'))
+            n_nodes_pred = self.count_descendants(pred)
+            n_nodes_true = self.count_descendants(true)
             n_nodes = max(n_nodes_pred, n_nodes_true)
             tree_pred = self.load_html_tree(pred)
             tree_true = self.load_html_tree(true)
-            distance = APTED(tree_pred, tree_true, CustomConfig()).compute_edit_distance()
-            return 1.0 - (float(distance) / n_nodes)
+            return tree_pred, tree_true, n_nodes
         else:
+            return None
+
+    @staticmethod
+    def calc_similarity(tree_pred, tree_true, n_nodes, config):
+        """Computes the similarity of two trees with the given apted configuration"""
+        distance = APTED(tree_pred, tree_true, config).compute_edit_distance()
+        return 1.0 - (float(distance) / n_nodes)
+
+    def evaluate(self, pred, true):
+        """Computes TEDS score between the prediction and the ground truth of a given sample"""
+        if (not pred) or (not true):
             return 0.0
+        trees = self.load_trees(pred, true)
+        if trees is None:
+            return 0.0
+        return self.calc_similarity(*trees, CustomConfig())
+
+    def evaluate_with_structure(self, pred, true):
+        """Computes TEDS and TEDS-S scores between the prediction and the ground truth
+        of a given sample, parsing both of them only once"""
+        if (not pred) or (not true):
+            return 0.0, 0.0
+        trees = self.load_trees(pred, true)
+        if trees is None:
+            return 0.0, 0.0
+        return (
+            self.calc_similarity(*trees, CustomConfig()),
+            self.calc_similarity(*trees, StructureOnlyConfig())
+        )
 
 
 def get_table_contents(text):
@@ -155,17 +265,17 @@ def extract_tables(data : dict) -> str:
     """
 
     # return as is if data is a string
-    html = '<html><body>'
+    html_parts = ['<html><body>']
     for elem in data['elements']:
-        if elem['category'].lower() == 'table':
+        if lower_category(elem['category']) == 'table':
             table_html_elements = get_table_contents(elem['content']['html'])
 
             for table_html in table_html_elements:
-                html += f'<table>{table_html}</table>'
+                html_parts.append(f'<table>{table_html}</table>')
 
-    html += '</body></html>'
+    html_parts.append('</body></html>')
 
-    return html
+    return ''.join(html_parts)
 
 
 def has_table_content(html_data : str) -> bool:
@@ -176,6 +286,10 @@ def has_table_content(html_data : str) -> bool:
     Returns:
         bool: True if the table has content, False otherwise
     """
+    # wrapped data, as built by extract_tables, only needs a length check
+    if html_data.startswith('<html><body>') and html_data.endswith('</body></html>'):
+        return len(html_data) > len('<html><body></body></html>')
+
     has_content = True
     if html_data.replace('<html><body>', '').replace('</body></html>', '') == '':
         has_content = False
@@ -195,9 +309,8 @@ def prepare_table_dataset(gt_data, pred_data):
 
     gt_table_list = []
     pred_table_list = []
-    for image_key in gt_data.keys():
+    for image_key, gt_elem in gt_data.items():
 
-        gt_elem = gt_data.get(image_key)
         pred_elem = pred_data.get(image_key)
 
         gt_tables = extract_tables(gt_elem)
@@ -212,6 +325,28 @@ def prepare_table_dataset(gt_data, pred_data):
     return gt_table_list, pred_table_list
 
 
+def refine_table_string(table_string):
+    """Wrap the table html string into a full html document and remove thead and tbody.
+
+    Args:
+        table_string (str): The table html string to refine.
+    Returns:
+        str: The refined html string.
+    """
+    # pick the missing wrapper once, then build the document in a single concatenation
+    if table_string.startswith('<table>') and table_string.endswith('</table>'):
+        prefix, suffix = '<html><body>', '</body></html>'
+    elif table_string.startswith('<html><body><table>') or table_string.endswith('</table></body></html>'):
+        prefix, suffix = '', ''
+    else:
+        prefix, suffix = '<html><body><table>', '</table></body></html>'
+
+    # remove thead and tbody
+    refined = THEAD_TBODY_PATTERN.sub('', prefix + table_string + suffix)
+
+    return refined
+
+
 def calc_table_score(gt_string, pred_string, evaluator):
     """Calculate the table evaluation score between the gold and pred strings.
 
@@ -222,37 +357,64 @@ def calc_table_score(gt_string, pred_string, evaluator):
     Returns:
         float: The table evaluation score.
     """
-    refined_pred = pred_string
-    refined_gold = gt_string
-    if pred_string.startswith('<table>') and pred_string.endswith('</table>'):
-        refined_pred = '<html><body>' + pred_string + '</body></html>'
-    elif not pred_string.startswith('<html><body><table>') and not pred_string.endswith('</table></body></html>'):
-        refined_pred = '<html><body><table>' + refined_pred + '</table></body></html>'
-
-    if gt_string.startswith('<table>') and gt_string.endswith('</table>'):
-        refined_gold = '<html><body>' + gt_string + '</body></html>'
-    elif not gt_string.startswith('<html><body><table>') and not gt_string.endswith('</table></body></html>'):
-        refined_gold = '<html><body><table>' + refined_gold + '</table></body></html>'
+    score = evaluator.evaluate(
+        refine_table_string(pred_string), refine_table_string(gt_string)
+    )
 
-    # remove thead and tbody
-    for tok in ['<thead>', '</thead>', '<tbody>', '</tbody>']:
-        refined_pred = refined_pred.replace(tok, '')
-        refined_gold = refined_gold.replace(tok, '')
+    return score
 
-    score = evaluator.evaluate(refined_pred, refined_gold)
 
-    return score
+def calc_table_scores(gt_string, pred_string, evaluator):
+    """Calculate the TEDS and TEDS-S scores between the gold and pred strings.
+
+    Args:
+        gt_string (str): The ground truth html string to compare.
+        pred_string (str): The predicted html string to compare.
+        evaluator (TEDS): The TEDS evaluator to use, the structure-only score is computed from the same trees.
+    Returns:
+        tuple(float, float): The TEDS and TEDS-S scores.
+    """
+    scores = evaluator.evaluate_with_structure(
+        refine_table_string(pred_string), refine_table_string(gt_string)
+    )
+
+    return scores
+
+
+def batch_calc_table_scores(gt_table_list, pred_table_list, evaluator):
+    """Calculate the TEDS and TEDS-S scores of all gold and pred string pairs.
+
+    Args:
+        gt_table_list (list): The ground truth html strings to compare.
+        pred_table_list (list): The predicted html strings to compare.
+        evaluator (TEDS): The TEDS evaluator to use.
+    Returns:
+        list: The TEDS and TEDS-S scores of each pair, in input order.
+    """
+    evaluators = repeat(evaluator, len(gt_table_list))
+    if evaluator.n_jobs == 1:
+        return list(map(calc_table_scores, gt_table_list, pred_table_list, evaluators))
+
+    # every pair is scored independently, so spread them over worker processes
+    chunksize = max(1, len(gt_table_list) // (evaluator.n_jobs * 4))
+    with ProcessPoolExecutor(max_workers=evaluator.n_jobs) as executor:
+        return list(executor.map(
+            calc_table_scores, gt_table_list, pred_table_list, evaluators,
+            chunksize=chunksize
+        ))
 
 
 def evaluate_table(
     gt : dict,
-    pred : dict
+    pred : dict,
+    n_jobs : int = 1,
 ) -> tuple:
     """Evaluate the table of the gt against the pred.
 
     Args:
         gt (dict): The gt layout to evaluate.
         pred (dict): The pred layout to evaluate against.
+        n_jobs (int): The number of processes used to score the tables.
 
     Returns:
         tuple(float, float): The TEDS and TEDS-S scores for the table evaluation.
@@ -268,22 +430,14 @@ def evaluate_table(
     elif len(pred_table_list) == 0:
         print('[Warning] No tables found in the prediction dataset.')
     else:
-        # Construct Table Evaluator for TEDS
-        # TEDS only evaluates the structure of the table
-        table_evaluator = TEDSEvaluator(structure_only=True)
-        teds_s_scores = []
-        for gt_table_elem, pred_table_elem in zip(gt_table_list, pred_table_list):
-            teds_s_score = calc_table_score(gt_table_elem, pred_table_elem, table_evaluator)
-            teds_s_scores.append(teds_s_score)
-        avg_teds_s_score= sum(teds_s_scores) / len(teds_s_scores)
-
-        # Construct Table Evaluator for TEDS-S
-        # TEDS-S evaluates the structure and content of the table
-        table_evaluator = TEDSEvaluator(structure_only=False)
-        teds_scores = []
-        for gt_table_elem, pred_table_elem in zip(gt_table_list, pred_table_list):
-            teds_score = calc_table_score(gt_table_elem, pred_table_elem, table_evaluator)
-            teds_scores.append(teds_score)
+        # Construct Table Evaluator for TEDS and TEDS-S
+        # TEDS evaluates the structure and content of the table
+        # TEDS-S only evaluates the structure of the table, from the same parsed trees
+        table_evaluator = TEDSEvaluator(structure_only=False, n_jobs=n_jobs)
+        scores = batch_calc_table_scores(gt_table_list, pred_table_list, table_evaluator)
+        teds_scores = [teds_score for teds_score, _ in scores]
+        teds_s_scores = [teds_s_score for _, teds_s_score in scores]
         avg_teds_score = sum(teds_scores) / len(teds_scores)
+        avg_teds_s_score = sum(teds_s_scores) / len(teds_s_scores)
 
     return avg_teds_score, avg_teds_s_score
@@ -1,7 +1,13 @@
+import os
 import json
 from pathlib import Path
 from typing import List
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 
 def read_file(path: str, supported_formats: str = ".json") -> dict:
     """Read a file and return its content as a string
@@ -28,8 +34,12 @@ def read_file(path: str, supported_formats: str = ".json") -> dict:
     if path.suffix not in supported_formats:
         raise ValueError(f"File format {path.suffix} not supported")
 
-    with path.open("r") as file:
-        file_content = json.load(file)
+    # use orjson when available, it parses the raw bytes considerably faster
+    if orjson is not None:
+        file_content = orjson.loads(path.read_bytes())
+    else:
+        with path.open("r") as file:
+            file_content = json.load(file)
 
     return file_content
 
@@ -67,14 +77,17 @@ def read_file_paths(path: str, supported_formats: List[str] = [".jpg"]) -> List[
     if not path.exists() or not path.is_dir():
         raise FileNotFoundError(f"Directory {path} not found")
 
-    # get the list of files in the directory
-    file_paths = [file for file in path.iterdir() if file.is_file()]
+    if not supported_formats:
+        return []
 
-    # filter file paths based on the supported formats
-    if supported_formats:
-        file_paths = [file for file in file_paths if file.suffix in supported_formats]
-    else:
-        file_paths = []
+    formats = frozenset(supported_formats)
+
+    # scandir entries cache the file type, so filtering does not stat every file
+    file_paths = []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_file() and os.path.splitext(entry.name)[1] in formats:
+                file_paths.append(path / entry.name)
 
     return file_paths
 
@@ -135,8 +148,7 @@ def check_data_validity(gt_data: dict, pred_data: dict) -> None:
         raise ValueError("Prediction data is empty")
 
     for image_key in gt_data.keys():
-        pred_elem = pred_data.get(image_key)
-        if pred_data is None:
+        if image_key not in pred_data:
             raise ValueError(
                 f"{image_key} not found in prediction. "
                 "Check if you are passing the correct data."